@@ -1,7 +1,10 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
 import streamlit as st
-import yfinance as yf
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
 from datetime import date, timedelta
 
 st.set_page_config(layout="wide")
@@ -27,18 +30,115 @@ def do_rerun():
     elif hasattr(st, "rerun"):
         st.rerun()
 
-# 🗓️ Cache do primeiro dia de negociação
-@st.cache_data(show_spinner=False)
+# 🗓️ Cache do primeiro dia de negociação (persistido em disco)
+# A data do primeiro pregão não muda; gravamos em JSON para que novas
+# sessões/reinícios do processo não refaçam o scrape do yfinance.
+FIRST_TRADE_CACHE = Path.home() / ".bt_first_trade.json"
+
+def _load_first_trade_cache() -> dict:
+    try:
+        return json.loads(FIRST_TRADE_CACHE.read_text())
+    except (OSError, ValueError):
+        return {}
+
+_first_trade_cache = _load_first_trade_cache()
+
+def _save_first_trade_cache():
+    try:
+        FIRST_TRADE_CACHE.write_text(json.dumps(_first_trade_cache))
+    except OSError:
+        pass
+
 def get_first_trade_date(ticker: str):
     """Retorna a data do primeiro pregão do ticker (ou None)."""
+    if ticker in _first_trade_cache:
+        cached = _first_trade_cache[ticker]
+        return date.fromisoformat(cached) if cached else None
     try:
-        info = yf.Ticker(ticker).info
-        epoch = info.get("firstTradeDateEpochUtc")
-        if epoch:
-            return pd.to_datetime(epoch, unit="s").date()
+        import yfinance as yf
+
+        epoch = yf.Ticker(ticker).info.get("firstTradeDateEpochUtc")
     except Exception:
-        pass
-    return None
+        # Falha transitória (rede, rate-limit): não cacheia, retenta depois
+        return None
+    # Só chega aqui com payload válido; "sem epoch" é resposta definitiva
+    # Só atualiza o dict (atômico sob o GIL); a gravação em disco fica com
+    # o chamador via _save_first_trade_cache, fora dos workers
+    result = pd.to_datetime(epoch, unit="s").date() if epoch else None
+    _first_trade_cache[ticker] = result.isoformat() if result else None
+    return result
+
+# 🌐 Downloads com cache (1 h) — reruns com os mesmos parâmetros não batem na rede
+@st.cache_data(ttl=3600, show_spinner=False)
+def _fetch_adj_close(tickers: tuple, start, end) -> pd.DataFrame:
+    """Baixa os preços ajustados dos tickers e normaliza para DataFrame."""
+    import yfinance as yf
+
+    # Janela padrão (10 anos até hoje): period= bate num endpoint do Yahoo
+    # com barras diárias pré-computadas. Fora do padrão, end + 1 dia torna
+    # a data final inclusiva (o intervalo do Yahoo é exclusivo no fim).
+    today = date.today()
+    if end == today and start == today - timedelta(days=365 * 10):
+        window = {"period": "10y"}
+    else:
+        window = {"start": start, "end": end + timedelta(days=1)}
+    data = yf.download(
+        list(tickers),
+        auto_adjust=False,
+        progress=False,
+        threads=True,
+        group_by="column",
+        actions=False,
+        **window,
+    )["Adj Close"]
+    if isinstance(data, pd.Series):
+        data = data.to_frame(name=tickers[0])
+    if isinstance(data.columns, pd.MultiIndex):
+        data.columns = data.columns.droplevel(0)
+    return data
+
+# 💾 Cache da serialização CSV — reruns não re-formatam o mesmo DataFrame
+@st.cache_data(show_spinner=False)
+def _df_to_csv_bytes(df: pd.DataFrame) -> bytes:
+    return df.to_csv().encode("utf-8")
+
+# ⚡ Kernel numérico: normaliza cada coluna pelo primeiro valor válido e
+# acumula a soma ponderada em uma única passada, sem temporários (T × N).
+# O numba é opcional — sem ele caímos no equivalente NumPy.
+try:
+    from numba import njit, prange
+
+    # fastmath restrito: o conjunto completo inclui 'nnan', que autorizaria
+    # o LLVM a dobrar os np.isnan() para False — e o kernel depende deles
+    # para pular as linhas pré-listagem (NaN por construção)
+    @njit(parallel=True, fastmath={"contract", "reassoc", "arcp"}, cache=True)
+    def _weighted_normalized_sum(X, w):
+        T, N = X.shape
+        firsts = np.empty(N)
+        for j in range(N):
+            firsts[j] = np.nan
+            for t in range(T):
+                v = X[t, j]
+                if not np.isnan(v):
+                    firsts[j] = v
+                    break
+        out = np.zeros(T)
+        for t in prange(T):
+            acc = 0.0
+            for j in range(N):
+                v = X[t, j]
+                fj = firsts[j]
+                if not np.isnan(v) and not np.isnan(fj):
+                    acc += (v / fj) * w[j]
+            out[t] = acc
+        return out
+
+except ImportError:
+
+    def _weighted_normalized_sum(X, w):
+        mask = ~np.isnan(X)
+        firsts = X[mask.argmax(axis=0), np.arange(X.shape[1])]
+        return np.nan_to_num(X / firsts) @ w
 
 # 📌 Session state
 if "tickers" not in st.session_state:
@@ -93,41 +193,45 @@ if not tickers:
 # ────────────────────────────────────────────────────────────────
 # 🔁 Backtest
 # ────────────────────────────────────────────────────────────────
+# O resultado fica em session_state: reruns disparados por outros widgets
+# (badges, inputs) apenas re-renderizam, sem recomputar nada. A chave de
+# parâmetros invalida o resultado quando tickers ou datas mudam.
+params_key = (tuple(tickers), str(start), str(end))
+
 if st.button("🔁 Rodar Backtest", type="primary") and tickers:
     try:
-        # 1) Dados da carteira --------------------------------------------------
-        raw_data = yf.download(
-            tickers,
-            start=start,
-            end=end,
-            auto_adjust=False,
-            progress=False,
-        )["Adj Close"]
-
-        if isinstance(raw_data, pd.Series):
-            raw_data = raw_data.to_frame(name=tickers[0])
-
-        if isinstance(raw_data.columns, pd.MultiIndex):
-            raw_data.columns = raw_data.columns.droplevel(0)
+        # 1) Dados da carteira + benchmark em uma única requisição --------------
+        # Ordenamos o cache key para que mudar a ordem dos tickers não invalide.
+        # O ^BVSP vai junto no mesmo download: uma requisição HTTP em vez de duas.
+        all_data = _fetch_adj_close(tuple(sorted(tickers)) + ("^BVSP",), start, end)
+        # float32 basta para plot/tabela base 100 e corta pela metade os
+        # bytes percorridos por toda a cadeia numérica
+        benchmark_data = all_data["^BVSP"].astype(np.float32)
+        raw_data = all_data.drop(columns="^BVSP").astype(np.float32)
 
         # 2) Limpa datas ANTES da listagem ---------------------------
         cleaned = raw_data.copy()
-        for col in cleaned.columns:
-            first_trade = get_first_trade_date(col)
-            if first_trade:
-                cleaned.loc[cleaned.index.date < first_trade, col] = pd.NA
-            cleaned.loc[cleaned[col] < 0.1, col] = pd.NA
+        # Lookups de primeiro pregão em paralelo: cada cache miss é uma
+        # chamada de rede independente, então I/O-bound e sem contenção de GIL
+        with ThreadPoolExecutor(max_workers=8) as ex:
+            first_trades = dict(
+                zip(cleaned.columns, ex.map(get_first_trade_date, cleaned.columns))
+            )
+        _save_first_trade_cache()
+        # Máscara única (datas × tickers) em vez de atribuições .loc por coluna.
+        # Comparamos o buffer datetime64[ns] do índice direto (sem cópia);
+        # só o array pequeno de primeiros pregões é convertido para ns.
+        idx_ns = cleaned.index.values
+        first_trade_arr = np.array(
+            [first_trades.get(c) or date(1900, 1, 1) for c in cleaned.columns],
+            dtype="datetime64[D]",
+        ).astype("datetime64[ns]")
+        mask = (idx_ns[:, None] < first_trade_arr[None, :]) | (cleaned.values < 0.1)
+        cleaned = cleaned.mask(mask)
         portfolio_data = cleaned
 
         # 3) Benchmark (Ibovespa) ------------------------------------
         benchmark_ticker = "^BVSP"
-        benchmark_data = yf.download(
-            benchmark_ticker,
-            start=start,
-            end=end,
-            auto_adjust=False,
-            progress=False,
-        )["Adj Close"]
 
         # 4) Alinhar datas ------------------------------------------
         combined = pd.concat([portfolio_data, benchmark_data], axis=1, join="inner")
@@ -136,63 +240,112 @@ if st.button("🔁 Rodar Backtest", type="primary") and tickers:
         benchmark_data = combined[benchmark_ticker]
 
         # 5) Normalizar coluna a coluna (primeiro valor válido) ------
-        def normalize_col(col):
-            first_valid = col.first_valid_index()
-            return col / col.loc[first_valid]
-
-        normalized_port = portfolio_data.apply(normalize_col, axis=0)
-        portfolio = (normalized_port * weights).sum(axis=1)
+        # bfill().iloc[0] entrega o primeiro valor válido de cada coluna de
+        # uma vez; a divisão vira um único broadcast em vez de N callbacks
+        first_valid = portfolio_data.bfill().iloc[0]
+        normalized_port = portfolio_data.div(first_valid, axis=1)
+        # Kernel fundido (normalização + soma ponderada) direto sobre .values
+        weights_arr = np.asarray(weights, dtype=np.float64)
+        portfolio = pd.Series(
+            _weighted_normalized_sum(portfolio_data.values, weights_arr),
+            index=portfolio_data.index,
+            name="Carteira",
+        )
         benchmark_norm = benchmark_data / benchmark_data.iloc[0]
 
+        # Benchmark alinhado ao índice da carteira: fatiamos uma vez e
+        # reutilizamos no gráfico, nas estatísticas e na tabela
+        aligned_bench = benchmark_norm.loc[portfolio.index]
+
         # 6) Gráfico -------------------------------------------------
-        st.subheader("📊 Retorno acumulado: Carteira vs. Ibovespa")
-        fig, ax = plt.subplots(figsize=(12, 5))
-        portfolio.plot(ax=ax, label="Carteira")
-        benchmark_norm.loc[portfolio.index].plot(ax=ax, label="Ibovespa")
-        ax.set_ylabel("Retorno acumulado (base 100)")
-        ax.grid(True)
-        ax.legend()
-        st.pyplot(fig)
+        chart_df = pd.DataFrame({"Carteira": portfolio, "Ibovespa": aligned_bench})
 
         # 7) Estatísticas -------------------------------------------
-        st.subheader("📌 Estatísticas da Carteira")
-        total_return = portfolio[-1] / portfolio[0] - 1
-        annualized_return = (portfolio[-1] / portfolio[0]) ** (1 / ((end - start).days / 365)) - 1
-        st.markdown(f"- **Retorno total:** {total_return:.2%}")
-        st.markdown(f"- **Retorno anualizado:** {annualized_return:.2%}")
-
-        st.subheader("📌 Estatísticas do Ibovespa")
-        ibov_total = benchmark_norm.loc[portfolio.index][-1] - 1
-        ibov_annual = benchmark_norm.loc[portfolio.index][-1] ** (1 / ((end - start).days / 365)) - 1
-        st.markdown(f"- **Retorno total:** {ibov_total:.2%}")
-        st.markdown(f"- **Retorno anualizado:** {ibov_annual:.2%}")
+        # Estatísticas finais em float64: escalares, custo zero
+        years = (end - start).days / 365.0
+        growth = float(portfolio.iat[-1]) / float(portfolio.iat[0])
+        total_return = growth - 1
+        annualized_return = growth ** (1 / years) - 1
+        b_end = float(aligned_bench.iat[-1])
+        ibov_total = b_end - 1
+        ibov_annual = b_end ** (1 / years) - 1
 
         # 8) Tabela base 100 ----------------------------------------
-        st.subheader("📋 Dados utilizados (base 100)")
-        table_norm = normalized_port.copy()
-        table_norm["Carteira"] = portfolio
-        table_norm["Ibovespa"] = benchmark_norm.loc[portfolio.index]
-        st.dataframe(table_norm.sort_index())
-
-        st.download_button(
-            "⬇️ Baixar CSV (base 100)",
-            data=table_norm.to_csv().encode("utf-8"),
-            file_name="backtest_base100.csv",
-            mime="text/csv",
+        # Montamos o frame a partir de um dict de colunas: uma alocação só,
+        # sem copy() + inserções que reconsolidam os blocos internos
+        table_norm = pd.DataFrame(
+            {
+                **{c: normalized_port[c] for c in normalized_port.columns},
+                "Carteira": portfolio,
+                "Ibovespa": aligned_bench,
+            }
         )
 
         # 9) Tabela de cotações -------------------------------------
-        st.subheader("📋 Cotações ajustadas (R$)")
-        price_df = portfolio_data.copy()
-        price_df["Ibovespa"] = benchmark_data
-        st.dataframe(price_df.sort_index())
-
-        st.download_button(
-            "⬇️ Baixar CSV (cotações)",
-            data=price_df.to_csv().encode("utf-8"),
-            file_name="backtest_quotes.csv",
-            mime="text/csv",
+        # index= explícito: o benchmark ainda tem as linhas que o
+        # dropna(how="all") removeu da carteira, e o dict-of-Series
+        # alinharia pela união dos índices
+        price_df = pd.DataFrame(
+            {
+                **{c: portfolio_data[c] for c in portfolio_data.columns},
+                "Ibovespa": benchmark_data,
+            },
+            index=portfolio_data.index,
         )
 
+        st.session_state["bt_result"] = {
+            "key": params_key,
+            "chart_df": chart_df,
+            "total_return": total_return,
+            "annualized_return": annualized_return,
+            "ibov_total": ibov_total,
+            "ibov_annual": ibov_annual,
+            "table_norm": table_norm,
+            "price_df": price_df,
+        }
+
     except Exception as e:
+        st.session_state.pop("bt_result", None)
         st.error(f"Erro ao executar o backtest: {str(e)}")
+
+# ────────────────────────────────────────────────────────────────
+# 📺 Resultados (renderizados a partir do session_state)
+# ────────────────────────────────────────────────────────────────
+result = st.session_state.get("bt_result")
+if result and result["key"] != params_key:
+    # Tickers ou datas mudaram desde o último backtest: resultado obsoleto
+    st.session_state.pop("bt_result", None)
+    result = None
+
+if result:
+    st.subheader("📊 Retorno acumulado: Carteira vs. Ibovespa")
+    st.line_chart(result["chart_df"])
+
+    st.subheader("📌 Estatísticas da Carteira")
+    st.markdown(f"- **Retorno total:** {result['total_return']:.2%}")
+    st.markdown(f"- **Retorno anualizado:** {result['annualized_return']:.2%}")
+
+    st.subheader("📌 Estatísticas do Ibovespa")
+    st.markdown(f"- **Retorno total:** {result['ibov_total']:.2%}")
+    st.markdown(f"- **Retorno anualizado:** {result['ibov_annual']:.2%}")
+
+    st.subheader("📋 Dados utilizados (base 100)")
+    # Arredondado só para exibição — o CSV baixado mantém a precisão cheia
+    st.dataframe(result["table_norm"].sort_index().round(4), height=400)
+
+    st.download_button(
+        "⬇️ Baixar CSV (base 100)",
+        data=_df_to_csv_bytes(result["table_norm"]),
+        file_name="backtest_base100.csv",
+        mime="text/csv",
+    )
+
+    st.subheader("📋 Cotações ajustadas (R$)")
+    st.dataframe(result["price_df"].sort_index().round(2), height=400)
+
+    st.download_button(
+        "⬇️ Baixar CSV (cotações)",
+        data=_df_to_csv_bytes(result["price_df"]),
+        file_name="backtest_quotes.csv",
+        mime="text/csv",
+    )